@@ -27,8 +27,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import re
 import struct
 import codecs
+from functools import lru_cache
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -39,11 +41,15 @@ import codecs
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 """ Helper data structures and functions """
 
-VALUE_FORMAT = {
+# struct formats are compiled once here so decoding a value never re-parses its format string
+VALUE_FORMAT = {k: struct.Struct(v) for k, v in {
 	'd':   '<i', 'u':   '<I', 'o':   '<I', 'x':   '<I', 'X':   '<I',
 	'hd':  '<h', 'hu':  '<H', 'ho':  '<H', 'hx':  '<H', 'hX':  '<H',
 	'hhd': '<b', 'hhu': '<B', 'hho': '<B', 'hhx': '<B', 'hhX': '<B',
-}
+}.items()}
+
+FLOAT_FORMAT        = struct.Struct('<f')
+BYTE_FORMAT         = struct.Struct('<B')
 
 SPECIAL_CHARS = {
 	'\xD8': 'X',
@@ -57,6 +63,12 @@ SPECIAL_CHARS = {
 NON_VALUE_CHARS     = set('cs%\0')
 FLOAT_VAL_CHARS     = set('eEfFgG')
 
+# length characters (and pairs) a format can end on -> (length string to report, characters to drop)
+LENGTH_SUFFIX = {
+	'hh': ('hh', 2), 'll': ('', 2),
+	'h':  ('h', 1),  'l':  ('', 1), 'L': ('', 1), 'j': ('', 1), 'z': ('', 1), 't': ('', 1),
+}
+
 SPECIFIER_CHARS     = (
 	set(SPECIAL_CHARS.values()) | 
 	set(SPECIAL_CHARS.keys()) | 
@@ -64,12 +76,62 @@ SPECIFIER_CHARS     = (
 	FLOAT_VAL_CHARS
 )
 
+# per-byte classification flags, indexed directly by the raw byte value
+CLS_SPEC, CLS_WILD = 1 << 0, 1 << 1
+
+def _classify(b: int) -> int:
+	c = chr(b)
+	return (
+		(CLS_SPEC if c in SPECIFIER_CHARS else 0) |
+		(CLS_WILD if c == '*' else 0)
+	)
+
+CLASS_TBL           = bytes(_classify(b) for b in range(256))
+
+# every specifier character resolves to a (kind, payload) pair with a single lookup
+SPEC_VALUE, SPEC_SPECIAL, SPEC_FLOAT, SPEC_PERCENT, SPEC_CHAR, SPEC_STRING, SPEC_NULL = range(7)
+
+NON_VALUE_SPECS = {
+	'%':  (SPEC_PERCENT, None),
+	'c':  (SPEC_CHAR, BYTE_FORMAT),
+	's':  (SPEC_STRING, None),
+	'\0': (SPEC_NULL, None),
+}
+
+SPEC_DISPATCH = {c: NON_VALUE_SPECS[c] for c in NON_VALUE_CHARS}
+SPEC_DISPATCH.update((c, (SPEC_FLOAT, FLOAT_FORMAT)) for c in FLOAT_VAL_CHARS)
+SPEC_DISPATCH.update((c, (SPEC_SPECIAL, SPECIAL_CHARS[c])) for c in SPECIAL_CHARS)
+SPEC_DISPATCH.update((c, (SPEC_VALUE, VALUE_FORMAT[c])) for c in VALUE_FORMAT if len(c) == 1)
+
+# specifiers that end a format but have no value decoding (e.g. 'i') print the format as-is,
+# same as a null-terminated format
+SPEC_DISPATCH.update((c, (SPEC_NULL, None)) for c in SPECIFIER_CHARS if c not in SPEC_DISPATCH)
+
+# matches the run of format bytes (flags, width, precision, length) up to the next specifier or '*',
+# built from CLASS_TBL so both decoders agree on where a format ends
+FMT_BODY = re.compile(b'[^' + re.escape(bytes(b for b in range(256) if CLASS_TBL[b])) + b']*')
+
 def sprintf(print_fmt: str, val: any) -> str:
 	try:
 		return (print_fmt % val)
 	except TypeError:
 		return print_fmt
 
+def checked_fmt(print_fmt: str, val: any) -> str:
+	# some formats can't be applied to their value (e.g. '%(x)d' wants a mapping), those get printed as-is.
+	# this is checked once per format with a sample value and returns the format to render values with;
+	# a failing format is rewritten into one that prints itself and swallows the value,
+	# so the decoders can always apply it directly - e.g. '%(x)d' becomes '%%(x)d%.0s',
+	# which renders any value as '%(x)d' (the escaped text, then the value cut to zero characters)
+	try:
+		print_fmt % val
+	except TypeError:
+		return print_fmt.replace('%', '%%') + '%.0s'
+	except ValueError:	# a malformed format still fails when the value gets printed, like before
+		pass
+
+	return print_fmt
+
 def parse_length_chars(print_fmt: str, val_char: str = None) -> tuple[str, str]:
 	# python printf does not like length characters that aren't h,l, and L
 	# we're supporting C99 printf form so a format that uses hh,ll,j,z,t should still be processed 
@@ -77,95 +139,135 @@ def parse_length_chars(print_fmt: str, val_char: str = None) -> tuple[str, str]:
 	# this function is meant to detect those length characters and remove them from the format
 	# It will also return a length string that contains an h or hh if found in the format,
 	# since that info correlates to how many bytes in the raw data pertain to the print value
-	len_char_set = set('hlLjzt')
-	len_chars = ''
-	if (print_fmt[-1] in len_char_set):
-		c = print_fmt[-1]
-		print_fmt = print_fmt[:-1]
-		if c == 'h':
-			len_chars = c
-			if print_fmt[-1] == 'h':
-				len_chars = c + print_fmt[-1]
-				print_fmt = print_fmt[:-1]
-		if c == 'l' and print_fmt[-1] == 'l':
-			print_fmt = print_fmt[:-1]
+	len_chars, drop = LENGTH_SUFFIX.get(print_fmt[-2:]) or LENGTH_SUFFIX.get(print_fmt[-1:], ('', 0))
+	print_fmt = print_fmt[:len(print_fmt) - drop]
 
 	if (val_char):
 		return print_fmt + val_char, len_chars + val_char
 	else:
 		return print_fmt, len_chars
 
+@lru_cache(maxsize=1024)
+def resolve_fmt(print_fmt: str) -> tuple[str, str | None, struct.Struct | None, int]:
+	# takes a format string that ends on its specifier character and works out
+	# the python format string, the format to render the value with (see checked_fmt),
+	# the struct used to unpack its value (if any) and the specifier kind
+	c = print_fmt[-1]
+
+	# running out of bytes leaves a non-specifier last, which is printed as-is
+	kind, payload = SPEC_DISPATCH.get(c, (SPEC_NULL, None))
+
+	val_struct = None
+	render_fmt = None
+
+	if (kind == SPEC_VALUE):
+		print_fmt, val_fmt = parse_length_chars(print_fmt[:-1], c)
+		# the dispatch payload is the struct for the plain specifier, an h/hh length picks a narrower one
+		val_struct = payload if val_fmt == c else VALUE_FORMAT[val_fmt]
+
+	elif (kind == SPEC_SPECIAL):
+		print_fmt = parse_length_chars(print_fmt[:-1], payload)[0]
+		val_struct = BYTE_FORMAT
+
+	elif (kind == SPEC_FLOAT or kind == SPEC_CHAR):
+		val_struct = payload
+
+	elif (kind == SPEC_STRING):
+		render_fmt = checked_fmt(print_fmt, '')
+
+	elif (kind == SPEC_NULL and c == '\0'):
+		print_fmt = print_fmt[:-1]
+
+	if (val_struct is not None):
+		# a zeroed buffer unpacks to a sample value of the right type
+		render_fmt = checked_fmt(print_fmt, val_struct.unpack(bytes(val_struct.size))[0])
+
+	return print_fmt, render_fmt, val_struct, kind
+
+@lru_cache(maxsize=1024)
+def compile_fmt(raw: bytes) -> tuple[str, str | None, struct.Struct | None, int]:
+	# same as resolve_fmt, but for the raw format bytes that follow the '\xA5' marker,
+	# up to and including the specifier byte
+	# latin-1 keeps the special specifier bytes (>0x7F) as the same characters chr() gives
+	if (b'*' not in raw):	# no wildcard width to expand, so the bytes convert in one go
+		return resolve_fmt('%' + raw.decode('latin-1'))
+
+	fmt_buf = bytearray(b'%')
+	i = 0
+
+	while (i < len(raw)):
+		if (CLASS_TBL[raw[i]] & CLS_WILD):
+			i = i + 1
+			fmt_buf.extend(str(raw[i]).encode('ascii'))
+		else:
+			fmt_buf.append(raw[i])
+		i = i + 1
+
+	return resolve_fmt(fmt_buf.decode('latin-1'))
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
 def printf_encode(data: str, errors='strict') -> tuple[str, int]:
 	# do nothing - no printf from the writer direction :)
 	return (bytes(data, 'ascii', errors), len(data))
 
-def printf_decode(data, errors='strict') -> tuple[str, int]:
-	if (type(data) == memoryview):
-		data_split = data.tobytes().split(b'\xA5', 1)
-	else:
-		data_split = data.split(b'\xA5', 1)
+def consume_fmt(data: bytes, pos: int, parts: list, errors='strict') -> int:
+	# renders the format that starts at pos (just after its '\xA5' marker) into parts,
+	# returning the position right after the format and its value
+	i = pos
 
-	r = data_split[0].decode('ascii', errors)
+	# find where the format ends, then compile it (or fetch it from the cache)
+	while (i < len(data)):
+		flags = CLASS_TBL[data[i]]
+		if (flags & CLS_WILD):
+			i = i + 1
+		i = i + 1
 
-	while (len(data_split) > 1):
-		print_data = data_split[1]
+		if (flags & CLS_SPEC):
+			break
 
-		i = 0
-		print_fmt = '%'
-		val_fmt = ''
+	print_fmt, render_fmt, val_struct, kind = compile_fmt(data[pos:i])
 
-		while (i < len(print_data)):
-			c = chr(print_data[i])
+	if (val_struct is not None):
+		parts.append(render_fmt % val_struct.unpack_from(data, i)[0])
+		i = i + val_struct.size
 
-			if c == '*':
-				i = i + 1
-				print_fmt = print_fmt + str(print_data[i])
-			elif c != '\0':
-				print_fmt = print_fmt + chr(print_data[i])
-			i = i + 1
+	elif (kind == SPEC_STRING):
+		end = data.find(b'\0', i)
+		if (end < 0):	# unterminated string - what follows is treated as plain text
+			s = ''
+		else:
+			s = data[i:end].decode('ascii', errors)
+			i = end + 1
+		parts.append(render_fmt % s)
 
-			if (c in SPECIFIER_CHARS):
-				break
+	elif (kind == SPEC_PERCENT):
+		parts.append('%')
 
-		if (c in VALUE_FORMAT):
-			print_fmt, val_fmt = parse_length_chars(print_fmt[:-1], c)
-			val_fmt = VALUE_FORMAT[val_fmt]
-			val_len = struct.calcsize(val_fmt)
-			r = r + sprintf(print_fmt, struct.unpack(val_fmt, print_data[i:i+val_len])[0])
-			i = i + val_len
+	else:	# null-terminator case or end-of-bytes case
+		parts.append(print_fmt)
 
-		elif (c in SPECIAL_CHARS):
-			print_fmt = parse_length_chars(print_fmt[:-1], SPECIAL_CHARS[c])[0]
-			r = r + sprintf(print_fmt, print_data[i])
-			i = i + 1
+	return i
 
-		elif (c in FLOAT_VAL_CHARS):
-			r = r + sprintf(print_fmt, struct.unpack('<f', print_data[i:i+4])[0])
-			i = i + 4
-		
-		else:
-			if (c == '%'):
-				r = r + '%'
-			elif (c == 'c'):
-				r = r + sprintf(print_fmt, print_data[i])
-				i = i + 1
-
-			elif (c == 's'):
-				end = print_data[i:].find(b'\0')
-				s = print_data[i:i+end].decode('ascii', errors)
-				i = i + end + 1
-				r = r + sprintf(print_fmt, s)
-			else:	# null-terminator case or end-of-bytes case
-				if (print_fmt[-1] == '\0'):
-					print_fmt = print_fmt[:-1]
-				r = r + print_fmt
-		
-		data_split = print_data[i:].split(b'\xA5', 1)
-		r = r + data_split[0].decode('ascii', errors)
+def printf_decode(data, errors='strict') -> tuple[str, int]:
+	# bytes() hands back bytes input as-is and only copies other buffer types
+	data = bytes(data)
+	n = len(data)
 
-	return (r, len(r))
+	r = []
+	pos = 0
+
+	while True:
+		j = data.find(b'\xA5', pos)
+		end = n if j < 0 else j
+
+		r.append(data[pos:end].decode('ascii', errors))
+		if (j < 0):
+			break
+
+		pos = consume_fmt(data, j + 1, r, errors)
+
+	return (''.join(r), len(data))
 
 class Printf_Codec(codecs.Codec):
     def encode(self, data: str, errors='strict') -> bytes:
@@ -189,99 +291,155 @@ class Printf_IncrementalDecoder(codecs.IncrementalDecoder):
 		self.errors = errors
 
 		self.print_fmt = ''
-		self.data_buffer = b''
+		self.render_fmt = None
+		self.data_buffer = bytearray()
 		self.val_len = 0
-		self.val_fmt = ''
+		self.val_struct = None
 
 		self.state = self.FIND_FMT_START
 
+		# state handlers, indexed by the state constants above
+		self._handlers = (
+			self._find_fmt_start,
+			self._find_fmt_end,
+			self._cap_value,
+			self._cap_text,
+			self._cap_wild,
+		)
+
 	def reset(self) -> None:
+		self._reset_scratch()
+
+	def _reset_scratch(self) -> None:
+		# clears the per-format fields, done as soon as a format has been printed
+		# so the next '\xA5' can start a new format right away
 		self.print_fmt = ''
-		self.data_buffer = b''
+		self.render_fmt = None
+		self.data_buffer.clear()
 		self.val_len = 0
-		self.val_fmt = ''
+		self.val_struct = None
 
 		self.state = self.FIND_FMT_START
 
 	def getstate(self) -> tuple[bytes, int]:
-		return (self.print_fmt.encode('ascii')+self.data_buffer, self.state)
+		return (self.print_fmt.encode('ascii') + bytes(self.data_buffer), self.state)
 	
 	def setstate(self, state: tuple[bytes, int]) -> None:
 		self.reset()
 		self.decode(state[0])
 
+	def _find_fmt_start(self, input: bytes, pos: int, r: list) -> int:
+		# start - look for '\xA5'
+		idx = input.find(b'\xA5', pos)
+		if (idx < 0):
+			idx = len(input)
+
+		r.append(input[pos:idx].translate(None, b'\0').decode('ascii', self.errors))
+
+		if (idx < len(input)):
+			self.print_fmt = '%'
+			self.state = self.FIND_FMT_END
+
+		return idx + 1
+
+	def _find_fmt_end(self, input: bytes, pos: int, r: list) -> int:
+		# copy the format body over in one go rather than byte by byte
+		idx = FMT_BODY.match(input, pos).end()
+		if (idx == len(input)):
+			self.print_fmt = self.print_fmt + input[pos:].decode('latin-1')
+			return idx
+
+		if (CLASS_TBL[input[idx]] & CLS_WILD):	# the width value arrives in the next byte
+			self.print_fmt = self.print_fmt + input[pos:idx].decode('latin-1')
+			self.state = self.CAP_WILD
+			return idx + 1
+
+		self.print_fmt, self.render_fmt, self.val_struct, kind = resolve_fmt(self.print_fmt + input[pos:idx+1].decode('latin-1'))
+
+		if self.val_struct is not None:
+			self.val_len = self.val_struct.size
+			self.state = self.CAP_VALUE
+
+		elif kind == SPEC_STRING:
+			self.state = self.CAP_TEXT
+
+		elif kind == SPEC_PERCENT:
+			r.append('%')
+			self._reset_scratch()
+
+		else:
+			r.append(self.print_fmt)
+			self._reset_scratch()
+
+		return idx + 1
+
+	def _cap_value(self, input: bytes, pos: int, r: list) -> int:
+		# grab as much of the value as this chunk holds in one slice
+		need = self.val_len - len(self.data_buffer)
+		self.data_buffer.extend(input[pos:pos+need])
+
+		if len(self.data_buffer) == self.val_len:
+			r.append(self.render_fmt % self.val_struct.unpack_from(self.data_buffer)[0])
+			self._reset_scratch()
+
+		return pos + need
+
+	def _cap_text(self, input: bytes, pos: int, r: list) -> int:
+		# the string runs until the null-terminator, which may be in a later chunk
+		idx = input.find(b'\0', pos)
+		if (idx < 0):
+			self.data_buffer.extend(input[pos:])
+			return len(input)
+
+		self.data_buffer.extend(input[pos:idx])
+		r.append(self.render_fmt % self.data_buffer.decode('ascii', self.errors))
+		self._reset_scratch()
+
+		return idx + 1
+
+	def _cap_wild(self, input: bytes, pos: int, r: list) -> int:
+		self.print_fmt = self.print_fmt + str(input[pos])
+		self.state = self.FIND_FMT_END
+
+		return pos + 1
+
 	def decode(self, input: bytes, final: bool = False) -> str:
-		r = ""
-		for val in input:
-			c = chr(val)
-			if self.state == self.FIND_FMT_START:	# start - look for '\xA5'
-				if c == '\xA5':
-					self.reset()
-					self.print_fmt = '%'
-					self.state = self.FIND_FMT_END
-				elif (c != '\0'):
-					r = r + c
-
-			elif self.state == self.FIND_FMT_END:
-				self.print_fmt = self.print_fmt + c
-
-				if c in VALUE_FORMAT:
-					self.print_fmt, self.val_fmt = parse_length_chars(self.print_fmt[:-1], c)
-					self.val_fmt = VALUE_FORMAT[self.val_fmt]
-					self.val_len = struct.calcsize(self.val_fmt)
-					self.state = self.CAP_VALUE
-
-				elif c in SPECIAL_CHARS:
-					self.print_fmt = parse_length_chars(self.print_fmt[:-1], SPECIAL_CHARS[c])[0]
-					self.val_fmt = '<B'
-					self.val_len = 1
-					self.state = self.CAP_VALUE
-				
-				elif c in FLOAT_VAL_CHARS:
-					self.val_fmt = '<f'
-					self.val_len = 4
-					self.state = self.CAP_VALUE
-
-				elif c in NON_VALUE_CHARS:
-					if c == 'c':
-						self.val_fmt = '<B'
-						self.len = 1
-						self.state = self.CAP_VALUE			
-					elif c == 's':
-						self.state = self.CAP_TEXT
-					elif c == '%':
-						r = r + '%'
-						self.FIND_FMT_START
-					else:
-						r = r + self.print_fmt
-						self.FIND_FMT_START
-				
-				elif c == '*':
-					self.print_fmt = self.print_fmt[0:-1]
-					self.state = self.CAP_WILD
-
-			elif self.state == self.CAP_VALUE:
-				self.data_buffer = self.data_buffer + val.to_bytes(1, 'little')
-				if len(self.data_buffer) == self.val_len:
-					self.state = self.FIND_FMT_START
-					r = r + sprintf(self.print_fmt, struct.unpack(self.val_fmt, self.data_buffer)[0])
-
-			elif self.state == self.CAP_TEXT:
-				if val == 0:
-					r = r + sprintf(self.print_fmt, self.data_buffer.decode('ascii', self.errors))
-					self.state = self.FIND_FMT_START
-				else:
-					self.data_buffer = self.data_buffer + val.to_bytes(1, 'little')
-
-			elif self.state == self.CAP_WILD:
-				self.print_fmt = self.print_fmt + str(val)
-				self.state = self.FIND_FMT_END
+		if (type(input) == memoryview):
+			input = input.tobytes()
+
+		# fast paths for reads that can't finish anything, which is most of them when a serial port
+		# hands over a few bytes per call - these skip the handler loop's fixed per-call cost
+		# (int membership tests are used as they're much cheaper than bytes ones on tiny inputs)
+		if (self.state == self.FIND_FMT_START):
+			if (0xA5 not in input):
+				if (0 in input):
+					input = input.translate(None, b'\0')
+				return input.decode('ascii', self.errors)
+
+		elif (not final):
+			if ((self.state == self.CAP_TEXT and 0 not in input) or
+				(self.state == self.CAP_VALUE and len(self.data_buffer) + len(input) < self.val_len)):
+				self.data_buffer.extend(input)
+				return ''
+
+			if (self.state == self.FIND_FMT_END and len(input) == 1 and not CLASS_TBL[input[0]]):
+				self.print_fmt = self.print_fmt + chr(input[0])
+				return ''
+
+		r = []
+		pos = 0
+		end = len(input)
+		handlers = self._handlers
+
+		# each handler consumes what it can from pos for the current state and returns where it stopped
+		while (pos < end):
+			pos = handlers[self.state](input, pos, r)
 
 		if (final and self.state != self.FIND_FMT_START):
-			r = r + self.print_fmt + self.data_buffer.decode('ascii', self.errors)
-			self.reset()
+			r.append(self.print_fmt + self.data_buffer.decode('ascii', self.errors))
+			self._reset_scratch()
 
-		return r
+		return ''.join(r)
 		
 class Printf_StreamWriter(Printf_Codec, codecs.StreamWriter):
     """Combination of Printf codec and StreamWriter"""